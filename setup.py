@@ -22,6 +22,7 @@
 # PO Box 3118, Prahran East, Victoria 3181, Australia.
 #
 
+import os
 import sys
 from distutils.core import setup
 import re
@@ -29,6 +30,19 @@ import re
 with open("subtidy/__init__.py", 'r') as f:
     version = re.search(r'__version__ = "(.*)"', f.read()).group(1)
 
+# Optionally compile the parser/generator module with mypyc.
+# This is opt-in, as the compiled module shadows subtidy_lib.py, which is not
+# what is wanted for an editable install. If mypyc is not available, we just
+# use the pure python module.
+#
+ext_modules = []
+if os.environ.get("SUBTIDY_USE_MYPYC", "0") == "1":
+    try:
+        from mypyc.build import mypycify
+        ext_modules = mypycify(["subtidy/subtidy_lib.py"])
+    except ImportError:
+        print("mypyc not available - using pure python subtidy_lib", file=sys.stderr)
+
 setup(name="subtidy",
       version=version,
       author="Andrew Starritt",
@@ -36,6 +50,7 @@ setup(name="subtidy",
       license="GPL3",
       description=""" Provides a means to perfrom consistant EPICS database/template file formatting """,
       packages=["subtidy"],
+      ext_modules=ext_modules,
       install_requires=[ "click" ], 
       entry_points="""
           [console_scripts]
@@ -14,42 +14,52 @@ from . import subtidy_lib
 
 # -----------------------------------------------------------------------------
 #
-def process_argument(filename, indent, spacing, width):
-    """ This function process, as in reformats, the specified filename.
-        Before formatting, it create a backup or backups.
+def create_backups(filename):
+    """ Creates a backup of filename, after first shuffling any existing backups.
     """
+    backup = filename + ".~"
+
+    # Create an immediate bakup and upto 4 backup backups.
+    #
+    # Only the contiguous run of existing backups starting from backup is
+    # shifted up by one; the oldest, if any, is replaced.
+    #
     try:
-        backup = filename + ".~"
+        chain = [backup] + [f"{filename}.{j}~" for j in range(1, 5)]
+
+        run = 0
+        while run < 4 and os.path.isfile(chain[run]):
+            run += 1
+
+        for j in reversed(range(run)):
+            os.replace(chain[j], chain[j + 1])
+    except BaseException:
+        pass
 
+    # Create a backup file.
+    # Note: we copy, as opposed to do moving original, file to create the back up
+    # and there by create a new file; and then process from the backup file back
+    # to the original file. In this way, filename remains the same file and gets
+    # updated. This preserves attributes and, at least on Linux, the inode number
+    # and any file-system hard links to the file are preserved.
+    # Note: the backup cannot itself be a hard link to filename, as filename is
+    # re-written in place, and that would also overwrite the backup.
+    #
+    shutil.copy(filename, backup)
+
+
+# -----------------------------------------------------------------------------
+#
+def process_argument(filename, indent, spacing, width, make_backup=True):
+    """ This function process, as in reformats, the specified filename.
+        Before formatting, it create a backup or backups, unless make_backup
+        is False.
+    """
+    try:
         print(filename)
 
-        # Create an immediate bakup and upto 4 backup backups.
-        #
-        try:
-            b1 = f"{filename}.1~"
-            b2 = f"{filename}.2~"
-            b3 = f"{filename}.3~"
-            b4 = f"{filename}.4~"
-
-            if os.path.isfile(backup):
-                if os.path.isfile(b1):
-                    if os.path.isfile(b2):
-                        if os.path.isfile(b3):
-                            os.rename(b3, b4)
-                        os.rename(b2, b3)
-                    os.rename(b1, b2)
-                os.rename(backup, b1)
-        except BaseException:
-            pass
-
-        # Create a backup file.
-        # Note: we copy, as opposed to do moving original, file to create the back up
-        # and there by create a new file; and then process from the backup file back
-        # to the original file. In this way, filename remains the same file and gets
-        # updated. This preserves attributes and, at least on Linux, the inode number
-        # and any file-system hard links to the file are preserved.
-        #
-        shutil.copy(filename, backup)
+        if make_backup:
+            create_backups(filename)
 
         subtidy_lib.process_file(filename, indent=indent, spacing=spacing, width=width)
         return 0
@@ -68,7 +78,7 @@ def print_version():
 
 # -----------------------------------------------------------------------------
 #
-def main(filenames, indent=4, spacing=2, width=120):
+def main(filenames, indent=4, spacing=2, width=120, make_backup=True):
     """ Ths main function organises the actual work.
         Call wehen subtidy used as a library
     """
@@ -82,7 +92,8 @@ def main(filenames, indent=4, spacing=2, width=120):
     else:
         print_version()
         for filename in filenames:
-            s = process_argument(filename, indent=indent, spacing=spacing, width=width)
+            s = process_argument(filename, indent=indent, spacing=spacing, width=width,
+                                 make_backup=make_backup)
             status = max(status, s)
         print("complete")
 
@@ -134,14 +145,18 @@ context_settings = dict(help_option_names=['--help', '-h'],
               default=120,
               show_default=True,
               help="""Specifies maximum output width (range 60 to 800).""")
+@click.option('--backup/--no-backup', 'make_backup',
+              default=True,
+              show_default=True,
+              help="""Specifies if backup files are created.""")
 @click.argument('filenames', nargs=-1)
-def cli(indent, spacing, width, filenames):
+def cli(indent, spacing, width, make_backup, filenames):
     """
 Copyright (c) 2022-2024  Andrew C. Starritt
 
 subtidy performs layout formatting on one or more EPICS substitution files.
 Prior to formating, a backup copy of each file is created with the name
-'<filename>.~'.
+'<filename>.~', unless --no-backup is specified.
 
 When no files names are provided, subtidy reads from stdin and writes
 to stdout.
@@ -163,7 +178,7 @@ file "db/xyz.template" {  # Comment
 # end\x1b[00m
     """
 
-    status = main(filenames, indent, spacing, width)
+    status = main(filenames, indent, spacing, width, make_backup)
     os._exit(status)
 
 
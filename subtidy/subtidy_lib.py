@@ -4,6 +4,8 @@
 import collections
 import enum
 import functools
+import io
+import re
 import sys
 
 from . import ParseError
@@ -16,6 +18,13 @@ reset = "\x1b[00m"
 do_debug = False
 
 
+# Indented comments within a substitution are re-indented with these prefixes,
+# the first for those before the pattern and the second for those amongst the rows.
+#
+comment_prefix = "    "
+row_comment_prefix = "            "
+
+
 # Used to hold an various items with a trailing comment
 #
 with_comment = collections.namedtuple("with_comment", ('item', 'comment'))
@@ -46,30 +55,46 @@ def debug(text, **kwd):
 
 
 # -----------------------------------------------------------------------------
+# Within quotes, token_re treats a backslash as escaping the next character.
+# So when a value is quoted, each " is escaped, and any run of backslashes
+# immediately before a " or at the end of the value is doubled, so that it
+# cannot escape the " that follows. Other backslashes are left as is.
+#
+quote_escape_re = re.compile(r'(\\*)("|\Z)')
+
+
+def quote_escape(match):
+    """ Used with quote_escape_re, see above
+    """
+    backslashes, quote = match.groups()
+    return backslashes * 2 + ('\\"' if quote else '')
+
+
+# -----------------------------------------------------------------------------
+# Substitution values tend to repeat, so cache the results.
 #
+@functools.lru_cache(maxsize=4096)
 def quote_str(value):
-    """ If value is not quoted (with ") and pre-fixes and post-fixes with "
+    """ If value is not quoted (with ") at both ends, pre-fixes and post-fixes with "
+        Such a value is escaped as necessary, so that the result may be re-read.
     """
-    if not value.startswith('"') and not value.endswith('"'):
-        value = '"' + value + '"'
-    return value
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value
+    return '"' + quote_escape_re.sub(quote_escape, value) + '"'
 
 
 # -----------------------------------------------------------------------------
 #
-def generate_row(item, target, widths, prefix, spaces, newlines):
+def generate_row(item, put, widths, prefix, spaces, newlines):
     """ Basically the same logic for formal row and actual rows
         item   - the formal or actutal [element]
-        target - the target file - must support write()
+        put    - function used to emit each output fragment, e.g. list.append
         widths - the width of each elemet in item
         prefix - either "pattern" or "       "
         spaces - the gap betweeen element on the frow, e.g. "  "
-        newlines - list of ints, defines when line breaks occur.
+        newlines - set of ints, defines when line breaks occur.
 
     """
-    putline = functools.partial(print, file=target)
-    put = functools.partial(print, end="", file=target)
-
     put(f"{prefix} {{ ")
 
     if isinstance(item, with_comment):
@@ -78,36 +103,59 @@ def generate_row(item, target, widths, prefix, spaces, newlines):
     else:
         c = None
 
-    number = len(item)
+    # Form modified prefix, used when a line break is required.
+    #
+    p = " " * len(prefix)
+
+    last = len(item) - 1
     for j, name in enumerate(item):
-        gap = ""
-        while len(name) + len(gap) < widths[j]:
-            gap = gap + " "
-
-        put(f"{name}")
-        if j < number - 1:
-            put(f",{spaces}")
-
-        if j in newlines and j < (number - 1):
-            # Form modified prefix.
-            p = " " * len(prefix)
-            put(f"\n{p}   ")
+        if j == last:
+            put(name.ljust(widths[j]))
+        elif j in newlines:
+            put(f"{name},{spaces}\n{p}   ")
         else:
-            put(gap)
+            # Pad after the comma, so that the commas follow the names.
+            #
+            put((name + ",").ljust(widths[j] + 1) + spaces)
 
     if c is None:
-        putline(f" }}")
+        put(f" }}\n")
     else:
-        putline(f" }}  {c}")
+        put(f" }}  {c}\n")
+
+
+# -----------------------------------------------------------------------------
+#
+def generate_flat_row(item, put, widths, prefix, spaces):
+    """ As generate_row, but for the common case when no line breaks are required.
+        Each row is formed by a single join and output using a single put.
+    """
+    if isinstance(item, with_comment):
+        tail = f" }}  {item.comment}\n"
+        item = item.item
+    else:
+        tail = " }\n"
+
+    # Each element but the last is followed by a comma, the spaces and then
+    # padded out to its width.
+    #
+    gap = len(spaces) + 1
+    last = len(item) - 1
+    put("".join([f"{prefix} {{ ",
+                 *[(name + ",").ljust(w + gap) for name, w in zip(item[:last], widths)],
+                 item[last].ljust(widths[last]),
+                 tail]))
 
 
 # -----------------------------------------------------------------------------
 #
 def generate_substitution(d, target, indent, spacing, width):
     """ Generates/putput the substitution specified in the dictionary d
+        The output is accumulated as a list of fragments, and written to
+        target in one go.
     """
-    putline = functools.partial(print, file=target)
-    put = functools.partial(print, end="", file=target)
+    buffer = []
+    put = buffer.append
 
     # convert to strings
     #
@@ -119,6 +167,9 @@ def generate_substitution(d, target, indent, spacing, width):
     comments = d['comments']
     formal = d['formal']
     actual = d['actual']
+    values = d['values']
+    ncols = d['ncols']
+    widths = d['widths']
     eos_comment = d['eos_comment']
 
     debug(f"   template: {template}")
@@ -127,48 +178,19 @@ def generate_substitution(d, target, indent, spacing, width):
     debug(f"   actual:")
     for act_item in actual:
         debug(f"      {act_item}")
+    debug(f"   values: {values}")
+    debug(f"   widths: {widths}")
     debug(f"   eos_comment: {eos_comment}\n")
 
-    widths = []
-    if isinstance(formal, with_comment):
-        f2 = formal.item
-        number = len(f2)
-        for name in f2:
-            widths.append(len(name))
-    else:
-        # Must be a simple list
-        #
-        number = len(formal)
-        for name in formal:
-            widths.append(len(name))
-
-    for row in actual:
-        if isinstance(row, str):
-            continue
-
-        if isinstance(row, with_comment):
-            row = row.item
-
-        n = len(row)
-        if n != number:
-            raise ValueError(f"{row} has {n} items, {number} expected")
-
-        for j, value in enumerate(row):
-            value = quote_str(value)
-            row[j] = value
-
-            w = len(value)
-            widths[j] = max(widths[j], w)
-
     # Now process the widths
     # newlines specify item after which a newline is required
     #
-    newlines = []
+    newlines = set()
     total = 10
     for j, w in enumerate(widths):
         total += w + spacing + 1
         if total > width:
-            newlines.append(j)
+            newlines.add(j)
             total = 10
 
     # - - - - - - - - - - - - - - - - - - -
@@ -177,37 +199,51 @@ def generate_substitution(d, target, indent, spacing, width):
     if isinstance(template, with_comment):
         c = template.comment
         template = quote_str(template.item)
-        putline(f"file {template} {{  {c}")
+        put(f"file {template} {{  {c}\n")
     else:
         # Must be a simpel str
         template = quote_str(template)
-        putline(f"file {template} {{")
+        put(f"file {template} {{\n")
 
     for c in comments:
-        if c.startswith(" "):
-            c = c.lstrip()
-            c = "    " + c
-        putline(f"{c}")
+        if c[:1] == " ":
+            c = comment_prefix + c.lstrip()
+        put(f"{c}\n")
+
+    if newlines:
+        put_row = functools.partial(generate_row, put=put, widths=widths, spaces=s, newlines=newlines)
+    else:
+        put_row = functools.partial(generate_flat_row, put=put, widths=widths, spaces=s)
 
-    generate_row(formal, target, widths, f"{i}pattern", s, newlines)
+    put_row(formal, prefix=f"{i}pattern")
 
     for row in actual:
         if isinstance(row, str):
             # This is a comment or white space
             # Output more or less as is.
             #
-            if row.startswith(" "):
-                row = row.lstrip()
-                row = "            " + row
-            putline(f"{row}")
+            if row[:1] == " ":
+                row = row_comment_prefix + row.lstrip()
+            put(f"{row}\n")
             continue
 
-        generate_row(row, target, widths, f"{i}       ", s, newlines)
+        # Otherwise a row number, possibly with a comment
+        #
+        if isinstance(row, with_comment):
+            start = row.item * ncols
+            row = with_comment(values[start:start + ncols], row.comment)
+        else:
+            start = row * ncols
+            row = values[start:start + ncols]
+
+        put_row(row, prefix=f"{i}       ")
 
     if eos_comment is None:
-        putline(f"}}")
+        put(f"}}\n")
     else:
-        putline(f"}}  {eos_comment}")
+        put(f"}}  {eos_comment}\n")
+
+    target.write("".join(buffer))
 
 
 # -----------------------------------------------------------------------------
@@ -222,11 +258,13 @@ def generate(source, target, indent, spacing, width):
     if not isinstance(source, (list, tuple)):
         raise TypeError(f"unexpected source, type: {type(source)}, expecting a list or tuple")
 
+    write = target.write
+
     for item in source:
         if isinstance(item, str):
-            # Simple - just print
+            # Simple - just write
             #
-            print(item.strip(), file=target)
+            write(item.strip() + "\n")
 
         elif isinstance(item, dict):
             generate_substitution(item, target=target, indent=indent, spacing=spacing, width=width)
@@ -237,11 +275,53 @@ def generate(source, target, indent, spacing, width):
 
 # -----------------------------------------------------------------------------
 # comment here includes blank lines
+# Note: the class form (as opposed to the functional form) allows subtidy_lib
+# to be compiled with mypyc - see setup.py
 #
-Tokens = enum.Enum("Tokens", ('comment', 'eol_comment',
-                              'file', 'pattern', 'name',
-                              'open_brace', 'close_brace',
-                              'comma', 'value', 'end_of_file'))
+class Tokens(enum.Enum):
+    comment = enum.auto()
+    eol_comment = enum.auto()
+    file = enum.auto()
+    pattern = enum.auto()
+    name = enum.auto()  # type: ignore[assignment]
+    open_brace = enum.auto()
+    close_brace = enum.auto()
+    comma = enum.auto()
+    value = enum.auto()
+    end_of_file = enum.auto()
+
+
+# -----------------------------------------------------------------------------
+# Regular expression used to tokenise each line. The group names match the
+# Tokens names where applicable. The file and pattern keywords must not be
+# immediately followed by a name character, e.g. filename is a name.
+# The eol_comment excludes any trailing white space.
+# Within a quoted value, a backslash escapes the next character, as per the
+# EPICS dbLoadTemplate lexer. Note: this is deliberately stricter than earlier
+# versions of subtidy, where the next " always closed the value, so a value
+# such as "C:\dir\" is now reported as missing its trailing quote.
+#
+token_re = re.compile(r"""
+      (?P<white_space>\s+)
+    | (?P<eol_comment>\#(?:.*\S)?)
+    | (?P<file>file(?![\w+\-:]))
+    | (?P<pattern>pattern(?![\w+\-:]))
+    | (?P<open_brace>\{)
+    | (?P<close_brace>\})
+    | (?P<comma>,)
+    | (?P<quoted>"(?:[^"\\]|\\.)*")
+    | (?P<unterminated>")
+    | (?P<text>[^\s,{}]+)
+""", re.VERBOSE)
+
+# Matches blank lines and whole line comments
+#
+comment_line_re = re.compile(r"\s*(?:\#.*)?$")
+
+# Tests if the whole of an unquoted text is a name as opposed to a value.
+# Yep: '+', '-' and ':' seem to be allowed in formal names
+#
+name_match = re.compile(r"[\w+\-:]+").fullmatch
 
 
 # -----------------------------------------------------------------------------
@@ -250,104 +330,302 @@ def get_token(source):
     """ Generator function to tokenise source
         Return a tuple (token type, literal if appliable or empty string, line number, col nunmer )
     """
-    lines = source.read().splitlines()
+    # Iterate the source directly, so that only one line is held at a time.
+    # There is no need to remove the trailing newline; it is just white space
+    # as far as token_re is concerned.
+    #
     lineno = 0
     col = 0
-    for line in lines:
-        lineno += 1
+    for lineno, line in enumerate(source, 1):
         col = 0
-        temp = line.rstrip()
-        size = len(temp) + 1
-        temp = temp.lstrip()
 
-        if len(temp) == 0 or temp[0] == '#':
+        if comment_line_re.match(line):
             yield (Tokens.comment, line.rstrip(), lineno, col)
             continue
 
-        while len(temp) > 0:
-            col = size - len(temp)
+        for match in token_re.finditer(line):
+            kind = match.lastgroup
+            col = match.start() + 1
 
-            if temp.startswith('#'):
-                yield (Tokens.eol_comment, temp.rstrip(), lineno, col)
-                temp = ""
+            if kind == 'white_space':
                 continue
 
-            elif temp.startswith('file'):
-                yield (Tokens.file, '', lineno, col)
-                temp = temp[4:].lstrip()
-                continue
+            elif kind == 'eol_comment':
+                yield (Tokens.eol_comment, match.group(), lineno, col)
 
-            if temp.startswith('pattern'):
-                yield (Tokens.pattern, '', lineno, col)
-                temp = temp[7:].lstrip()
-                continue
+            elif kind == 'quoted':
+                yield (Tokens.value, match.group(), lineno, col)
 
-            if temp.startswith('{'):
-                yield (Tokens.open_brace, '', lineno, col)
-                temp = temp[1:].lstrip()
-                continue
+            elif kind == 'unterminated':
+                name = getattr(source, 'name', '<source>')
+                msg = 'value missing trailing " (within quotes, \\" is an escaped quote)'
+                raise ParseError(f"{name}:{lineno}:{col} {msg}")
 
-            if temp.startswith('}'):
-                yield (Tokens.close_brace, '', lineno, col)
-                temp = temp[1:].lstrip()
-                continue
-
-            if temp.startswith(','):
-                yield (Tokens.comma, '', lineno, col)
-                temp = temp[1:].lstrip()
-                continue
+            elif kind == 'text':
+                # must be a name or unquoted value
+                #
+                text = match.group()
+                token = Tokens.name if name_match(text) else Tokens.value
+                yield (token, text, lineno, col)
 
-            # must be a name/value
-            #
-            if temp.startswith('"'):
-                # Is a quoted value - find end quote
-                # TODO - worry about e.g. "ABC\"DEF"
+            else:
+                # file, pattern, braces and comma
                 #
-                q = temp.find('"', 1)
-                if q < 0:
-                    raise ParseError(f"{source.name}:{lineno}:{col} value missing trailing \"")
-                q += 1    # include the quote character
-                yield (Tokens.value, temp[:q], lineno, col)
-                temp = temp[q:].lstrip()
-                continue
+                yield (Tokens[kind], '', lineno, col)
 
-            # must be a name or unquoted value
-            #
-            a1 = temp.find(',')
-            if a1 < 0:
-                a1 = len(temp)
+        # end match
+    # end lines
+
+    # We return an explicit end of file token
+    #
+    yield (Tokens.end_of_file, '', lineno, col)
 
-            a2 = temp.find('{')
-            if a2 < 0:
-                a2 = len(temp)
 
-            a3 = temp.find('}')
-            if a3 < 0:
-                a3 = len(temp)
+# -----------------------------------------------------------------------------
+# Need better state names
+#
+class States(enum.Enum):
+    seek_file = enum.auto()
+    start1 = enum.auto()
+    start2 = enum.auto()
+    seek_pattern = enum.auto()
+    start_formal = enum.auto()
+    seek_name = enum.auto()
+    post_name = enum.auto()
+    start_actual_first = enum.auto()
+    start_actual_next = enum.auto()
+    seek_value = enum.auto()
+    post_value = enum.auto()
 
-            a4 = temp.find(' ')
-            if a4 < 0:
-                a4 = len(temp)
 
-            a = min(a1, a2, a3, a4)
-            text = temp[:a].rstrip()
+# -----------------------------------------------------------------------------
+# Parser actions.
+# Each action is called with the parse context dictionary, the token literal,
+# and the line/col numbers. The context holds:
+#   'name'   - the source name, used in warnings and errors
+#   'result' - the list of comments and substitution dictionaries
+#   'block'  - the substitution dictionary currently being parsed
+#   'row'    - the index into the block's values of the current row's first value
+# Values are quoted, and column widths accumulated, as each row is closed.
+# Each action returns the next state, or None if the state is unchanged.
+#
+def parse_warning(ctx, lineno, col, msg):
+    """ Outputs a warning qualified by the source name and position
+    """
+    warning(f"{ctx['name']}:{lineno}:{col} {msg}")
 
-            token = Tokens.name
-            for c in text:
-                if not c.isalnum() and c not in "_+-:":
-                    # Yep: '+', '-' and ':' seem to be allowed in formal names
-                    token = Tokens.value
-                    break
 
-            yield (token, text, lineno, col)
-            temp = temp[a:].lstrip()
+def append_result_comment(ctx, literal, lineno, col):
+    ctx['result'].append(literal)
 
-        # end temp
-    # end lines
 
-    # We return an explicit end of file token
+def ignore_token(ctx, literal, lineno, col):
+    pass
+
+
+def start_file(ctx, literal, lineno, col):
+    ctx['block'] = {'template': None,
+                    'comments': [],
+                    'formal': [],
+                    'actual': [],
+                    'values': [],
+                    'ncols': 0,
+                    'widths': [],
+                    'eos_comment': None}
+    return States.start1
+
+
+def set_eos_comment(ctx, literal, lineno, col):
+    last_item = ctx['result'][-1]
+    last_item['eos_comment'] = literal
+
+
+def set_template(ctx, literal, lineno, col):
+    ctx['block']['template'] = literal
+    return States.start2
+
+
+def open_file(ctx, literal, lineno, col):
+    return States.seek_pattern
+
+
+def set_template_comment(ctx, literal, lineno, col):
+    block = ctx['block']
+    block['template'] = with_comment(block['template'], literal)
+
+
+def append_block_comment(ctx, literal, lineno, col):
+    ctx['block']['comments'].append(literal)
+
+
+def start_pattern(ctx, literal, lineno, col):
+    return States.start_formal
+
+
+def open_pattern(ctx, literal, lineno, col):
+    return States.seek_name
+
+
+def append_name(ctx, literal, lineno, col):
+    ctx['block']['formal'].append(literal)
+    return States.post_name
+
+
+def extra_name_comma(ctx, literal, lineno, col):
+    last_name = ctx['block']['formal'][-1]
+    parse_warning(ctx, lineno, col, f"extra comma following macro name {last_name} removed")
+    return States.seek_name
+
+
+def extra_name_comma_close(ctx, literal, lineno, col):
+    extra_name_comma(ctx, literal, lineno, col)
+    return close_pattern(ctx, literal, lineno, col)
+
+
+def missing_name_comma(ctx, literal, lineno, col):
+    last_name = ctx['block']['formal'][-1]
+    parse_warning(ctx, lineno, col, f"missing comma between macro names {last_name} and {literal}")
+    return append_name(ctx, literal, lineno, col)
+
+
+def post_name_comma(ctx, literal, lineno, col):
+    return States.seek_name
+
+
+def close_pattern(ctx, literal, lineno, col):
+    block = ctx['block']
+    block['ncols'] = len(block['formal'])
+    block['widths'] = [len(name) for name in block['formal']]
+    return States.start_actual_first
+
+
+def set_formal_comment(ctx, literal, lineno, col):
+    block = ctx['block']
+    block['formal'] = with_comment(block['formal'], literal)
+
+
+def set_row_comment(ctx, literal, lineno, col):
+    actual = ctx['block']['actual']
+    actual[-1] = with_comment(actual[-1], literal)
+
+
+def append_actual_comment(ctx, literal, lineno, col):
+    ctx['block']['actual'].append(literal)
+
+
+def open_row(ctx, literal, lineno, col):
+    ctx['row'] = len(ctx['block']['values'])
+    return States.seek_value
+
+
+def append_value(ctx, literal, lineno, col):
+    ctx['block']['values'].append(literal)
+    return States.post_value
+
+
+def last_row_value(ctx):
+    """ Returns the current row's last value, or None if the row is empty so far.
+    """
+    values = ctx['block']['values']
+    return values[-1] if len(values) > ctx['row'] else None
+
+
+def extra_value_comma(ctx, literal, lineno, col):
+    last_value = last_row_value(ctx)
+    if last_value is None:
+        parse_warning(ctx, lineno, col, "extra comma at start of row removed")
+    else:
+        parse_warning(ctx, lineno, col, f"extra comma following value {last_value} removed")
+    return States.seek_value
+
+
+def extra_value_comma_close(ctx, literal, lineno, col):
+    # If the row is empty, e.g. { }, there was no comma, and close_row reports
+    # the missing values.
     #
-    yield (Tokens.end_of_file, '', lineno, col)
+    if last_row_value(ctx) is not None:
+        extra_value_comma(ctx, literal, lineno, col)
+    return close_row(ctx, literal, lineno, col)
+
+
+def missing_value_comma(ctx, literal, lineno, col):
+    # Only reached from post_value, so the row has at least one value.
+    #
+    last_value = last_row_value(ctx)
+    parse_warning(ctx, lineno, col, f"missing comma between values {last_value} and {literal}")
+    return append_value(ctx, literal, lineno, col)
+
+
+def post_value_comma(ctx, literal, lineno, col):
+    return States.seek_value
+
+
+def close_row(ctx, literal, lineno, col):
+    # The values are held in one flat list; actual just records the row number.
+    #
+    block = ctx['block']
+    start = ctx['row']
+    ncols = block['ncols']
+    n = len(block['values']) - start
+    if n != ncols:
+        row = block['values'][start:]
+        raise ParseError(f"{ctx['name']}:{lineno}:{col} {row} has {n} items, {ncols} expected")
+
+    # Quote the row's values, and widen the columns as needed.
+    #
+    row = [quote_str(value) for value in block['values'][start:]]
+    block['values'][start:] = row
+    block['widths'] = list(map(max, block['widths'], map(len, row)))
+
+    block['actual'].append(start // ncols)
+    ctx['row'] = None
+    return States.start_actual_next
+
+
+def close_file(ctx, literal, lineno, col):
+    ctx['result'].append(ctx['block'])
+    ctx['block'] = None
+    return States.seek_file
+
+
+# -----------------------------------------------------------------------------
+# The parser state transition table: (state, token) => action
+# Any state/token combination not in the table is a parse error.
+#
+transitions = {
+    (States.seek_file, Tokens.comment): append_result_comment,
+    (States.seek_file, Tokens.end_of_file): ignore_token,
+    (States.seek_file, Tokens.file): start_file,
+    (States.seek_file, Tokens.eol_comment): set_eos_comment,
+    (States.start1, Tokens.value): set_template,
+    (States.start2, Tokens.open_brace): open_file,
+    (States.seek_pattern, Tokens.eol_comment): set_template_comment,
+    (States.seek_pattern, Tokens.comment): append_block_comment,
+    (States.seek_pattern, Tokens.pattern): start_pattern,
+    (States.start_formal, Tokens.open_brace): open_pattern,
+    (States.seek_name, Tokens.name): append_name,
+    (States.seek_name, Tokens.comma): extra_name_comma,
+    (States.seek_name, Tokens.close_brace): extra_name_comma_close,
+    (States.post_name, Tokens.name): missing_name_comma,
+    (States.post_name, Tokens.comma): post_name_comma,
+    (States.post_name, Tokens.close_brace): close_pattern,
+    (States.start_actual_first, Tokens.eol_comment): set_formal_comment,
+    (States.start_actual_next, Tokens.eol_comment): set_row_comment,
+    (States.start_actual_first, Tokens.comment): append_actual_comment,
+    (States.start_actual_next, Tokens.comment): append_actual_comment,
+    (States.start_actual_first, Tokens.open_brace): open_row,
+    (States.start_actual_next, Tokens.open_brace): open_row,
+    (States.seek_value, Tokens.value): append_value,
+    (States.seek_value, Tokens.name): append_value,
+    (States.seek_value, Tokens.comma): extra_value_comma,
+    (States.seek_value, Tokens.close_brace): extra_value_comma_close,
+    (States.post_value, Tokens.value): missing_value_comma,
+    (States.post_value, Tokens.name): missing_value_comma,
+    (States.post_value, Tokens.comma): post_value_comma,
+    (States.post_value, Tokens.close_brace): close_row,
+    (States.start_actual_first, Tokens.close_brace): close_file,
+    (States.start_actual_next, Tokens.close_brace): close_file,
+}
 
 
 # -----------------------------------------------------------------------------
@@ -355,179 +633,24 @@ def get_token(source):
 def process_source(source):
     """ Parse source substitution file
     """
-
-    # Need better state names
+    # Not all file-like objects, e.g. io.StringIO, have a name.
     #
-    States = enum.Enum("States", ('seek_file', 'start1', 'start2', 'seek_pattern',
-                                  'start_formal', 'seek_name', 'post_name',
-                                  'start_actual_first', 'start_actual_next',
-                                  'seek_value', 'post_value'))
+    ctx = {'name': getattr(source, 'name', '<source>'),
+           'result': [],
+           'block': None,
+           'row': None}
 
-    result = []
     state = States.seek_file
 
-    template = None
-    comments = None
-    formal = None
-    actual = None
-    actual_row = None
-    eos_comment = None
-
     for token, literal, lineno, col in get_token(source):
-
-        st = (state, token)
-
-        # Now examine the state-token combination
-        # The 3.10  match case ... case ... syntax would be nice here.
-        #
-        if st == (States.seek_file, Tokens.comment):
-            result.append(literal)
-
-        elif st == (States.seek_file, Tokens.end_of_file):
-            # This is not unexpected.
-            break
-
-        elif st == (States.seek_file, Tokens.file):
-            comments = []
-            formal = []
-            actual = []
-            state = States.start1
-
-        elif st == (States.seek_file, Tokens.eol_comment):
-            last = len(result) - 1
-            last_item = result[last]
-            last_item['eos_comment'] = literal
-
-        elif st == (States.start1, Tokens.value):
-            template = literal
-            state = States.start2
-
-        elif st == (States.start2, Tokens.open_brace):
-            state = States.seek_pattern
-
-        elif st == (States.seek_pattern, Tokens.eol_comment):
-            template = with_comment(template, literal)
-
-        elif st == (States.seek_pattern, Tokens.comment):
-            comments.append(literal)
-
-        elif st == (States.seek_pattern, Tokens.pattern):
-            state = States.start_formal
-
-        elif st == (States.start_formal, Tokens.open_brace):
-            state = States.seek_name
-
-        elif st == (States.seek_name, Tokens.name):
-            formal.append(literal)
-            state = States.post_name
-
-        elif st == (States.seek_name, Tokens.comma):
-            last = len(formal) - 1
-            last_name = formal[last]
-            msg = f"extra comma following macro name {last_name} removed"
-            warning(f"{source.name}:{lineno}:{col} {msg}")
-            state = States.seek_name
-
-        elif st == (States.seek_name, Tokens.close_brace):
-            last = len(formal) - 1
-            last_name = formal[last]
-            msg = f"extra comma following macro name {last_name} removed"
-            warning(f"{source.name}:{lineno}:{col} {msg}")
-            state = States.start_actual_first
-
-        elif st == (States.post_name, Tokens.name):
-            last = len(formal) - 1
-            last_name = formal[last]
-            msg = f"missing comma between macro names {last_name} and {literal}"
-            warning(f"{source.name}:{lineno}:{col} {msg}")
-            formal.append(literal)
-            state = States.post_name
-
-        elif st == (States.post_name, Tokens.comma):
-            state = States.seek_name
-
-        elif st == (States.post_name, Tokens.close_brace):
-            state = States.start_actual_first
-
-        elif st == (States.start_actual_first, Tokens.eol_comment):
-            formal = with_comment(formal, literal)
-
-        elif st == (States.start_actual_next, Tokens.eol_comment):
-            last = len(actual) - 1
-            last_row = actual[last]
-            last_row = with_comment(last_row, literal)
-            actual[last] = last_row
-
-        elif st == (States.start_actual_first, Tokens.comment):
-            actual.append(literal)
-
-        elif st == (States.start_actual_next, Tokens.comment):
-            actual.append(literal)
-
-        elif st == (States.start_actual_first, Tokens.open_brace) or \
-                st == (States.start_actual_next, Tokens.open_brace):
-            actual_row = []
-            state = States.seek_value
-
-        elif st == (States.seek_value, Tokens.value) or \
-                st == (States.seek_value, Tokens.name):
-            actual_row.append(literal)
-            state = States.post_value
-
-        elif st == (States.seek_value, Tokens.comma):
-            last = len(actual_row) - 1
-            last_value = actual_row[last]
-            msg = f"extra comma following value {last_value} removed"
-            warning(f"{source.name}:{lineno}:{col} {msg}")
-            state = States.seek_value
-
-        elif st == (States.seek_value, Tokens.close_brace):
-            last = len(actual_row) - 1
-            last_value = actual_row[last]
-            msg = f"extra comma following value {last_value} removed"
-            warning(f"{source.name}:{lineno}:{col} {msg}")
-            actual.append(actual_row)
-            actual_row = None
-            state = States.start_actual_next
-
-        elif st == (States.post_value, Tokens.value) or \
-                st == (States.post_value, Tokens.name):
-            last = len(actual_row) - 1
-            last_value = actual_row[last]
-            msg = f"missing comma between values {last_value} and {literal}"
-            warning(f"{source.name}:{lineno}:{col} {msg}")
-            actual_row.append(literal)
-            state = States.post_value
-
-        elif st == (States.post_value, Tokens.comma):
-            state = States.seek_value
-
-        elif st == (States.post_value, Tokens.close_brace):
-            actual.append(actual_row)
-            actual_row = None
-            state = States.start_actual_next
-
-        elif st == (States.start_actual_first, Tokens.close_brace) or \
-                st == (States.start_actual_next, Tokens.close_brace):
-            d = {'template': template,
-                 'comments': comments,
-                 'formal': formal,
-                 'actual': actual,
-                 'eos_comment': eos_comment}
-            result.append(d)
-            template = None
-            comments = None
-            formal = None
-            actual = None
-            eos_comment = None
-
-            state = States.seek_file
-
-        else:
+        action = transitions.get((state, token))
+        if action is None:
             msg = "unexpected state/token combination"
-            raise ParseError(f"{source.name}:{lineno}:{col} {msg}: {state.name}/{token.name}")
+            raise ParseError(f"{ctx['name']}:{lineno}:{col} {msg}: {state.name}/{token.name}")
+
+        state = action(ctx, literal, lineno, col) or state
 
-    return result
+    return ctx['result']
 
 
 # -----------------------------------------------------------------------------
@@ -554,8 +677,17 @@ def process_file(filename, indent, spacing, width):
     #
     with open(filename, 'r') as source:
         sub_file = process_source(source)
+        encoding = source.encoding
+
+    # Likewise, we generate the whole output into memory first, and encode it
+    # using the same encoding as was used to read the file. We then write it
+    # to filename in one go.
+    #
+    buffer = io.StringIO()
+    generate(sub_file, target=buffer, indent=indent, spacing=spacing, width=width)
+    data = buffer.getvalue().encode(encoding)
 
-    with open(filename, 'w') as target:
-        generate(sub_file, target=target, indent=indent, spacing=spacing, width=width)
+    with open(filename, 'wb') as target:
+        target.write(data)
 
 # end